@@ -1,14 +1,24 @@
 import argparse
+import concurrent.futures
 import json
 import os.path
+import threading
 import time
 import urllib.parse
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter, Retry
+from selectolax.parser import HTMLParser
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 USER_AGENT = "discogs-export/1.0"
+MAX_CONCURRENT_REQUESTS = 4
+MAX_RATE_LIMIT_RETRIES = 6
 
 URL_BASE = "https://www.discogs.com"
 API_BASE = "https://api.discogs.com"
@@ -18,25 +28,99 @@ IDENTITY_URL_FMT = f"{API_BASE}/oauth/identity?token={{token}}"
 WANTLIST_URL_FMT = f"{API_BASE}/users/{{username}}/wants?page={{pagenum}}&per_page={{per_page}}&token={{token}}"
 COLLECTION_URL_FMT = f"{API_BASE}/users/{{username}}/collection/folders/0/releases?page={{pagenum}}&per_page={{per_page}}&token={{token}}"
 
+RATINGS_ROW_SELECTOR = "table.release_list_table tbody tr"
+RATING_SELECTOR = "span.rating"
+RELEASE_ANCHOR_SELECTOR = 'span.release_title a[href^="/release"]'
+ARTIST_ANCHOR_SELECTOR = 'span.release_title a[href^="/artist"]'
+
+
+# orjson is much faster for large exports, but optional.
+def _json_dumps(obj):
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+def _write_json(filepath, obj):
+    with open(filepath, 'wb') as json_file:
+        json_file.write(_json_dumps(obj))
+
+# Writes a JSON array one entry at a time, so the whole list never has to be in memory.
+# Entries may still be fetched mid-write, so write to a temporary file and only replace
+# the previous export once the array is complete.
+def _write_json_stream(filepath, entries):
+    tmp_filepath = f"{filepath}.tmp"
+    try:
+        with open(tmp_filepath, 'wb') as json_file:
+            json_file.write(b"[")
+            for index, entry in enumerate(entries):
+                if index:
+                    json_file.write(b",")
+                json_file.write(_json_dumps(entry))
+            json_file.write(b"]")
+    except BaseException:
+        os.remove(tmp_filepath)
+        raise
+    os.replace(tmp_filepath, filepath)
+
+
+class RateLimiter:
+    """Tracks the remaining Discogs request budget from the rate limit response headers."""
+    def __init__(self, threshold=5, window=60):
+        self.threshold = threshold
+        self.window = window
+        self.limit = None
+        self.remaining = None
+        self._lock = threading.Lock()
+
+    def wait(self):
+        # Only pace requests out once the budget is nearly spent, so bursts go through untouched.
+        with self._lock:
+            if self.remaining is not None and self.remaining < self.threshold:
+                time.sleep(self.window / self.limit)
+
+    def update(self, headers):
+        with self._lock:
+            if "X-Discogs-Ratelimit-Remaining" in headers:
+                self.remaining = int(headers["X-Discogs-Ratelimit-Remaining"])
+                self.limit = int(headers.get("X-Discogs-Ratelimit", self.limit or self.window))
+
+# Discogs limits by source IP, so every client shares one budget.
+_rate_limiter = RateLimiter()
+
 
 class _DiscogsApiBase:
     def __init__(self, user_agent):
-        self.headers = {"User-Agent": user_agent}
+        # Rate limiting (429) is handled in _get, so only retry on transient server errors here.
+        # Once the retries run out, hand back the last response like any other failed request.
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                              max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[502, 503, 504],
+                                                raise_on_status=False))
+        self._session = requests.Session()
+        self._session.headers.update({"User-Agent": user_agent})
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
 
     def _get(self, url):
-        resp = requests.get(url, headers=self.headers)
-        if resp.status_code == 429:
+        attempt = 0
+        while True:
+            _rate_limiter.wait()
+            resp = self._session.get(url)
+            _rate_limiter.update(resp.headers)
+            if resp.status_code != 429:
+                return resp
+            if attempt >= MAX_RATE_LIMIT_RETRIES:
+                resp.raise_for_status()
+
             print("Making requests too quickly. Taking a break, then continuing...")
-            time.sleep(60)
+            time.sleep(min(60 * 2**attempt, 600))
             print("Continuing...")
-            return self._get(url)
-        return resp
+            attempt += 1
 
 class DiscogsHtmlApi(_DiscogsApiBase):
     def __init__(self, user_agent, cookie):
         super().__init__(user_agent)
 
-        self.headers["cookie"] = cookie
+        self._session.headers["cookie"] = cookie
         
     def ratings(self, username, pagenum, per_page=500):
         url = RATINGS_URL_FMT.format(username=username, pagenum=pagenum, per_page=per_page)
@@ -85,35 +169,35 @@ class DiscogsHtmlClient:
 
     @staticmethod
     def _parse_release_info(row):
-        release_anchor = row.select('span.release_title a[href^="/release"]').pop()
-        release_path = DiscogsHtmlClient.url_short_form(release_anchor.get('href'))
+        release_anchor = row.css(RELEASE_ANCHOR_SELECTOR)[-1]
+        release_path = DiscogsHtmlClient.url_short_form(release_anchor.attributes['href'])
         return {
-            "name": release_anchor.get_text(),
+            "name": release_anchor.text(),
             "url": f"{URL_BASE}{release_path}"
         }
 
     @staticmethod
     def _parse_artists_info(row):
         artists_info = []
-        for artist_anchor in row.select('span.release_title a[href^="/artist"]'):
+        for artist_anchor in row.css(ARTIST_ANCHOR_SELECTOR):
             artists_info.append({
-                "name": artist_anchor.get_text(),
-                "url": f"{URL_BASE}{DiscogsHtmlClient.url_short_form(artist_anchor.get('href'))}"
+                "name": artist_anchor.text(),
+                "url": f"{URL_BASE}{DiscogsHtmlClient.url_short_form(artist_anchor.attributes['href'])}"
             })
         return artists_info
 
     @staticmethod
     def _parse_release_ratings_html(page_html):
-        page = BeautifulSoup(page_html, 'html.parser')
+        page = HTMLParser(page_html)
         
         info = []
-        for row in page.select("table.release_list_table tbody tr"):
-            rating_tag = row.select("span.rating").pop()
+        for row in page.css(RATINGS_ROW_SELECTOR):
+            rating_tag = row.css(RATING_SELECTOR)[-1]
 
             entry = {
                 "artists": DiscogsHtmlClient._parse_artists_info(row),
                 "release": DiscogsHtmlClient._parse_release_info(row),
-                "rating": rating_tag["data-value"]
+                "rating": rating_tag.attributes["data-value"]
             }
             info.append(entry)
 
@@ -134,16 +218,8 @@ class DiscogsHtmlClient:
 
         return all_items
 
-    def export_release_ratings(self, export_dir):
-        rating_info = self._iter_pages(self._api.ratings, self._parse_release_ratings_html)
-
-        print("Writing result...")
-        os.makedirs(export_dir, exist_ok=True)
-        dest_filepath = os.path.join(export_dir, "release-ratings.json")
-        with open(dest_filepath, 'w') as discogs_ratings_file:
-            json.dump(rating_info, discogs_ratings_file)
-
-        return dest_filepath
+    def release_ratings(self):
+        return self._iter_pages(self._api.ratings, self._parse_release_ratings_html)
 
 class DiscogsRestClient:
     def __init__(self, user_agent, token):
@@ -155,17 +231,19 @@ class DiscogsRestClient:
         release_info = self._api.release(release_id)
         return release_info.get("master_url")
     
+    # The first page tells us how many pages there are, so the rest can be fetched concurrently.
     def _iter_pages(self, api_func, root_key):
-        pagenum = 1
-        while True:
-            resp_json = api_func(self.username, pagenum)
-            for entry in resp_json[root_key]:
-                yield entry
+        resp_json = api_func(self.username, 1)
+        yield from resp_json[root_key]
 
-            if pagenum == resp_json["pagination"]["pages"]:
-                break
+        page_count = resp_json["pagination"]["pages"]
+        if page_count <= 1:
+            return
 
-            pagenum += 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            pages = executor.map(lambda pagenum: api_func(self.username, pagenum), range(2, page_count + 1))
+            for resp_json in pages:
+                yield from resp_json[root_key]
 
     def _collection(self):
         return self._iter_pages(self._api.list_collection, "releases")
@@ -191,63 +269,71 @@ class DiscogsRestClient:
 
     @staticmethod
     def _collect_release_info(release_list):
-        release_info = []
         for item in release_list:
-            release_info.append({
+            yield {
                 "artists": [DiscogsRestClient._extract_artist_info(artist_json) for artist_json in item["basic_information"]["artists"]],
                 "release": DiscogsRestClient._extract_release_info(item["basic_information"])
-            })
-        return release_info
+            }
 
     def export_collection(self, export_dir):
         collection_info = DiscogsRestClient._collect_release_info(self._collection())
 
-        os.makedirs(export_dir, exist_ok=True)
         filepath = os.path.join(export_dir, "collection.json")
-        with open(filepath, 'w') as collection_file:
-            json.dump(collection_info, collection_file)
+        _write_json_stream(filepath, collection_info)
 
         return filepath
 
     def export_wantlist(self, export_dir):
         wantlist_info = DiscogsRestClient._collect_release_info(self._wantlist())
 
-        os.makedirs(export_dir, exist_ok=True)
         filepath = os.path.join(export_dir, "wantlist.json")
-        with open(filepath, 'w') as wantlist_file:
-            json.dump(wantlist_info, wantlist_file)
+        _write_json_stream(filepath, wantlist_info)
 
         return filepath
 
 
-def _get_master_url(release_info):
+def _get_master_url(rest_client, release_info):
     release_url = release_info["release"]["url"]
     release_path = urllib.parse.urlparse(release_url).path
     release_id = release_path.split('/')[-1]
-    master_url = rest_client.release_master_url(release_id)
-    return {**relase_info, "master_url": master_url}
+    try:
+        master_url = rest_client.release_master_url(release_id)
+    except (requests.RequestException, ValueError) as exc:
+        # One bad release shouldn't throw away hours of lookups. The importer falls back to
+        # matching by release and artist when there's no master.
+        print(f"Couldn't get the master of {release_url}: {exc}")
+        master_url = None
+    # Nested under "release", matching the REST exports, since that's where the importer looks.
+    return {**release_info, "release": {**release_info["release"], "master_url": master_url}}
 
 def export_release_ratings(html_client, rest_client, export_dir, include_master):
-    ratings_filepath = html_client.export_release_ratings(export_dir)
+    ratings_json = html_client.release_ratings()
 
     if include_master:
-        with open(ratings_filepath) as ratings_file:
-            ratings_json = json.load(ratings_file)
-
-        updated_ratings_json = []
-        for entry in ratings_json:
-            updated_ratings_json.append(_get_master_url(entry))
-
-            # Throttle the requests, since we'll likely be making a lot.
-            time.sleep(0.75)
-        
-        with open(ratings_filepath, 'w') as ratings_file:
-            ratings_json = json.dump(updated_ratings_json, ratings_file)
+        # The shared rate limiter keeps these concurrent lookups within the Discogs quota.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            futures = [executor.submit(_get_master_url, rest_client, entry) for entry in ratings_json]
+            done, not_done = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            failed = next((future for future in done if future.exception()), None)
+            if failed:
+                # Don't keep fetching releases whose results would be thrown away.
+                for future in not_done:
+                    future.cancel()
+                raise failed.exception()
+            ratings_json = [future.result() for future in futures]
+
+    # Only written once the optional master URLs are in, so the file is never rewritten.
+    print("Writing result...")
+    ratings_filepath = os.path.join(export_dir, "release-ratings.json")
+    _write_json(ratings_filepath, ratings_json)
+
+    return ratings_filepath
 
 def export(user_agent, cookie, token, include_master, export_dir):
     html_client = DiscogsHtmlClient(user_agent, cookie)
     rest_client = DiscogsRestClient(user_agent, token)
 
+    os.makedirs(export_dir, exist_ok=True)
     export_release_ratings(html_client, rest_client, export_dir, include_master)
     rest_client.export_collection(export_dir)
     rest_client.export_wantlist(export_dir)
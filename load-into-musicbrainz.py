@@ -1,18 +1,46 @@
 import argparse
+import concurrent.futures
+import functools
 import json
+import operator
 import os
+import sqlite3
+import threading
 import urllib.parse
 from getpass import getpass
 
 import musicbrainzngs
 import musicbrainzngs.musicbrainz
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 from musicbrainzngs.musicbrainz import _do_mb_put
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 WEB_LOGIN_URL = "https://musicbrainz.org/login"
 NEW_COLLECTION_URL = "https://musicbrainz.org/collection/create"
+# Only the top few results are ever close enough to be candidates.
+SEARCH_LIMIT = 10
+MAX_LOOKUP_WORKERS = 4
+DISCOGS_API_BASE = "https://api.discogs.com"
+DISCOGS_WWW_BASE = "https://www.discogs.com"
+DISCOGS_API_TO_WWW_PREFIXES = [
+    (f"{DISCOGS_API_BASE}/releases/", f"{DISCOGS_WWW_BASE}/release/"),
+    (f"{DISCOGS_API_BASE}/masters/", f"{DISCOGS_WWW_BASE}/master/"),
+    (f"{DISCOGS_API_BASE}/artists/", f"{DISCOGS_WWW_BASE}/artist/")
+]
+
+MBID_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "discogs-to-musicbrainz", "mbid_cache.sqlite")
+
+# The collection type dropdown doesn't change, so only scrape it once.
+_collection_types = {}
+
+_print_lock = threading.Lock()
 
 
 # musicbrainzngs only supports adding releases to collections for some reason.
@@ -23,14 +51,85 @@ def add_release_groups_to_collection(collection, release_groups=[]):
     Collection and release groups should be identified by their MBIDs
     """
     # XXX: Maximum URI length of 16kb means we can only submit ~400 release groups at once.
-    chunk_size = 200
-    for index in range(0, len(release_groups), chunk_size):
-        chunk = release_groups[index:index + chunk_size + 1]
+    # Each MBID is 37 characters with its separator, so 375 leaves some margin.
+    chunk_size = 375
+    index = 0
+    while index < len(release_groups):
+        chunk = release_groups[index:index + chunk_size]
         print(chunk[-1])
         release_group_list = ";".join(chunk)
-        _do_mb_put(f"collection/{collection}/release-groups/{release_group_list}")
+        try:
+            _do_mb_put(f"collection/{collection}/release-groups/{release_group_list}")
+        except musicbrainzngs.WebServiceError as exc:
+            # URI too long. Shrink the chunk and retry it. musicbrainzngs doesn't treat 414 as
+            # a client error, so it retries the request for about a minute before giving up
+            # with a NetworkError; that delay is accepted, since 375 should rarely overflow.
+            if getattr(exc.cause, "code", None) == 414 and chunk_size > 1:
+                chunk_size //= 2
+                continue
+            raise
+        index += len(chunk)
+
+class _MbidCache:
+    """Persists Discogs URL to MBID lookups across runs, so re-imports only query new items."""
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if not self._conn:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS mbid (url TEXT, type_name TEXT, mbid TEXT, PRIMARY KEY (url, type_name))")
+        return self._conn
+
+    def get(self, url, type_name):
+        with self._lock:
+            row = self._connect().execute("SELECT mbid FROM mbid WHERE url = ? AND type_name = ?", (url, type_name)).fetchone()
+        return row[0] if row else None
+
+    def set(self, url, type_name, mbid):
+        with self._lock:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO mbid VALUES (?, ?, ?)", (url, type_name, mbid))
+
+_mbid_cache = _MbidCache(MBID_CACHE_PATH)
+
+# Misses aren't persisted, since a relation may be added to Musicbrainz before the next run.
+def _persist_mbid_lookup(lookup_func):
+    @functools.wraps(lookup_func)
+    def wrapper(url, type_name):
+        mbid = _mbid_cache.get(url, type_name)
+        if not mbid:
+            mbid = lookup_func(url, type_name)
+            if mbid:
+                _mbid_cache.set(url, type_name, mbid)
+        return mbid
+    return wrapper
+
+# Lookups run on several threads, so make sure only one of them looks up a given URL.
+# The rest wait for it, then find the result in the cache.
+def _single_flight(lookup_func):
+    locks = {}
+    locks_lock = threading.Lock()
+
+    @functools.wraps(lookup_func)
+    def wrapper(*args):
+        with locks_lock:
+            lock = locks.setdefault(args, threading.Lock())
+        with lock:
+            return lookup_func(*args)
+    return wrapper
 
 def discog_api_url_to_www(api_url):
+    # Nearly every URL is a plain Discogs URL, so skip the parsing for those.
+    if api_url.startswith(DISCOGS_WWW_BASE):
+        return api_url
+    for api_prefix, www_prefix in DISCOGS_API_TO_WWW_PREFIXES:
+        if api_url.startswith(api_prefix):
+            return www_prefix + api_url[len(api_prefix):]
+
     parsed = urllib.parse.urlparse(api_url)
     fixed = parsed._replace(netloc=parsed.netloc.replace("api", "www"))
     if parsed.path.startswith("/releases"):
@@ -51,15 +150,20 @@ def search_release_group_by_artists(discog_entry, artist_mbids):
 
     rg_results = []
     for artist_mbid in artist_mbids:
-        search_results = musicbrainzngs.search_release_groups(discog_entry["release"]["name"], arid=artist_mbid)
-        release_group_list = search_results["release-group-list"]
-        if int(release_group_list[0]["ext:score"]) > 95:
-            return [release_group_info(release_group_list[0])]
+        search_results = musicbrainzngs.search_release_groups(discog_entry["release"]["name"], arid=artist_mbid, limit=SEARCH_LIMIT)
+        scored_release_groups = [(int(rg["ext:score"]), rg) for rg in search_results["release-group-list"]]
+        if scored_release_groups and scored_release_groups[0][0] > 95:
+            return [release_group_info(scored_release_groups[0][1])]
         
-        rg_results.extend([release_group_info(rg) for rg in release_group_list if int(rg["ext:score"]) >= 75])
+        rg_results.extend([(score, release_group_info(rg)) for score, rg in scored_release_groups if score >= 75])
     
-    return sorted(rg_results, key=lambda rg: int(rg["ext:score"]), reverse=True)
+    rg_results.sort(key=operator.itemgetter(0), reverse=True)
+    return [info for _, info in rg_results]
 
+# The same artists and masters show up across many entries, so remember what we've already looked up.
+@_single_flight
+@functools.lru_cache(maxsize=None)
+@_persist_mbid_lookup
 def lookup_mbid_by_discog_url(url, type_name):
     uri = discog_api_url_to_www(url)
     includes = [f"{type_name}-rels"]
@@ -72,8 +176,12 @@ def lookup_mbid_by_discog_url(url, type_name):
     connection = next((relation for relation in relation_list if relation["type"] == "discogs"), None)
     return connection[type_name]["id"] if connection else None
 
+# Lazy, so the search can stop looking up artists once it finds a confident match.
 def lookup_artist_mbids(discog_entry):
-    return [lookup_mbid_by_discog_url(artist["url"], "artist") for artist in discog_entry["artists"]]
+    for artist in discog_entry["artists"]:
+        artist_mbid = lookup_mbid_by_discog_url(artist["url"], "artist")
+        if artist_mbid:
+            yield artist_mbid
 
 def lookup_release_mbid(discog_entry):
     return lookup_mbid_by_discog_url(discog_entry["release"]["url"], "release")
@@ -97,19 +205,41 @@ def lookup_master_mbid(discog_entry):
         if len(results) == 1:
             master_id = results[0]["id"]
         else:
-            print(f"Candidates for {discog_entry['release']['name']} by {discog_entry['artist']['name']}:")
-            for info in results:
-                print(f"{info['name']} by {info['artist']}: {info['id']}")
+            artist_names = ", ".join(artist["name"] for artist in discog_entry["artists"])
+            lines = [f"Candidates for {discog_entry['release']['name']} by {artist_names}:"]
+            lines.extend(f"{info['name']} by {info['artist']}: {info['id']}" for info in results)
+            # Lookups run on several threads, so keep each entry's candidates together.
+            with _print_lock:
+                print("\n".join(lines))
     return master_id
 
+# musicbrainzngs holds its rate limit lock for the whole request, so only one request is
+# ever in flight. The workers just overlap the local work (parsing, cache lookups) with it.
+def lookup_master_mbids(discog_entries):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_LOOKUP_WORKERS) as executor:
+        futures = [executor.submit(lookup_master_mbid, entry) for entry in discog_entries]
+        done, not_done = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+        failed = next((future for future in done if future.exception()), None)
+        if failed:
+            # Don't spend hours on lookups whose results would be thrown away.
+            for future in not_done:
+                future.cancel()
+            raise failed.exception()
+        return [future.result() for future in futures]
+
 def load_discogs_releases(import_dir, filename):
-    with open(os.path.join(import_dir, filename)) as releases_file:
+    with open(os.path.join(import_dir, filename), 'rb') as releases_file:
+        if orjson:
+            return orjson.loads(releases_file.read())
         return json.load(releases_file)
 
 def _get_collection_types(session):
+    if _collection_types:
+        return _collection_types
+
     get_resp = session.get("https://musicbrainz.org/collection/create")
 
-    page = BeautifulSoup(get_resp.text, 'html.parser')
+    page = BeautifulSoup(get_resp.text, 'lxml')
     dropdown = page.find(id="id-edit-list.type_id")
     last_parent = None
     collection_type_dict = {}
@@ -120,6 +250,7 @@ def _get_collection_types(session):
         else:
             last_parent = name
         collection_type_dict[name.lower()] = option.attrs["value"]
+    _collection_types.update(collection_type_dict)
     return collection_type_dict
 
 def _new_collection(session, name, collection_type):
@@ -135,7 +266,7 @@ def _new_collection(session, name, collection_type):
 def _web_login(session):
     get_resp = session.get(WEB_LOGIN_URL)
 
-    page = BeautifulSoup(get_resp.text, 'html.parser')
+    page = BeautifulSoup(get_resp.text, 'lxml')
 
     payload = {
         "csrf_session_key": page.find("input", attrs={"name": "csrf_session_key"}).attrs["value"],
@@ -146,10 +277,18 @@ def _web_login(session):
 
     session.post(WEB_LOGIN_URL, data=payload)
 
-def create_collection(name, collection_type):
+# Log in once, and share the session across all web UI calls.
+@functools.lru_cache(maxsize=1)
+def _mb_web_session():
     session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=4)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
     _web_login(session)
-    _new_collection(session, name, collection_type)
+    return session
+
+def create_collection(name, collection_type):
+    _new_collection(_mb_web_session(), name, collection_type)
 
 def mb_collection(name):
     collections = musicbrainzngs.get_collections()["collection-list"]
@@ -163,12 +302,13 @@ def import_to_collection(collection_name, releases):
         if not collection:
             print(f"There was an issue creating {collection_name}. Skipping...")
             return
-    release_groups = [master_mbid for entry in releases if (master_mbid := lookup_master_mbid(entry))]
+    release_groups = [master_mbid for master_mbid in lookup_master_mbids(releases) if master_mbid]
     add_release_groups_to_collection(collection["id"], release_groups)
 
 def import_ratings(import_dir):
     discogs_ratings = load_discogs_releases(import_dir, "release-ratings.json")
-    release_group_ratings = {master_mbid: (int(entry["rating"]) * 20) for entry in discogs_ratings if (master_mbid := lookup_master_mbid(entry))}
+    master_mbids = lookup_master_mbids(discogs_ratings)
+    release_group_ratings = {master_mbid: (int(entry["rating"]) * 20) for entry, master_mbid in zip(discogs_ratings, master_mbids) if master_mbid}
     musicbrainzngs.submit_ratings(release_group_ratings=release_group_ratings)
 
 def import_to_wishlist(import_dir, wishlist_name):